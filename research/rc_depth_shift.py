@@ -2,47 +2,112 @@
 # University of Texas at Austin
 # Fall, 2016
 
-from netCDF4 import Dataset
+from netCDF4 import Dataset, default_fillvals
 import pandas
-import scipy
-import scipy.interpolate
-from scipy.stats import norm
-from collections import Counter
-import scipy.optimize
+import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
-import csv
-import itertools
-import urllib
-import re
-import operator
+from urllib.request import urlopen
+from urllib.error import URLError
+from concurrent.futures import ThreadPoolExecutor
+import math
+import io
+import os
+import hashlib
+import tempfile
+import time
+try:
+	from numba import njit
+except ImportError: # numba is optional
+	njit = None
+
+if njit is not None:
+	@njit(cache=True)
+	def _mannings(area,hydrad,slope,disch):
+		"""Single-pass kernel for RCDist.mannings_n (1-D arrays, scalar slope)"""
+		out = np.empty_like(disch)
+		sqrt_slope = math.sqrt(slope)
+		for i in range(disch.shape[0]):
+			out[i] = 1.49*area[i]*hydrad[i]**(2.0/3.0)*sqrt_slope/disch[i]
+		return out
+else:
+	def _mannings(area,hydrad,slope,disch):
+		"""Vectorized RCDist.mannings_n when numba is unavailable"""
+		return 1.49*area*np.power(hydrad,2/3.0)*np.sqrt(slope)/disch
+
+# On-disk cache of downloaded USGS pages, kept next to this script
+_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'.cache')
+_cache_max_age = 7*24*3600 # seconds before a cached page is refetched; 0 disables the disk cache
+_url_cache = {}
+
+def _fetch_url(url):
+	"""Returns the raw bytes at url, caching them in memory and in _cache_dir
+	under the sha256 of the url so later runs skip the download"""
+	if url in _url_cache:
+		return _url_cache[url]
+	path = os.path.join(_cache_dir,hashlib.sha256(url.encode('utf-8')).hexdigest())
+	if _cache_max_age > 0 and os.path.exists(path) and \
+		time.time() - os.path.getmtime(path) < _cache_max_age:
+		with open(path,'rb') as f:
+			raw = f.read()
+	else:
+		raw = urlopen(url).read()
+		if _cache_max_age > 0:
+			os.makedirs(_cache_dir,exist_ok=True)
+			# Write to a unique temp file so concurrent fetches of the same url
+			# don't collide, then swap it in so only complete downloads are seen
+			fd, tmp = tempfile.mkstemp(dir=_cache_dir)
+			with os.fdopen(fd,'wb') as f:
+				f.write(raw)
+			os.replace(tmp,path)
+	_url_cache[url] = raw
+	return raw
+
+def open_dataset(nc):
+	"""Returns nc (a path or an already open Dataset) as an open Dataset 
+	with masked-array wrapping turned off; use read_filled to read values"""
+	if not isinstance(nc,Dataset):
+		nc = Dataset(nc,'r')
+	nc.set_auto_mask(False)
+	return nc
+
+def read_filled(var,key,dtype=np.float64):
+	"""Returns var[key] as a dtype array with fill values set to NaN, 
+	since datasets are read without auto-masking (see open_dataset)"""
+	raw = var[key]
+	out = np.asarray(raw,dtype=dtype) # no copy when var already has this dtype
+	if not out.flags.writeable:
+		out = out.copy()
+	fill = getattr(var,'_FillValue',default_fillvals.get(var.dtype.str[1:]))
+	if fill is not None:
+		out[raw == fill] = np.nan
+	return out
+
+def comid_index(nc):
+	"""Returns dict of comid to row index, read once from the COMID
+	variable of open Dataset nc"""
+	return {c:i for i,c in enumerate(np.asarray(nc.variables['COMID'][:]).tolist())}
 
 class RCData:
 
-	def __init__(self, comid, hand_curves, hand_curves_idx, 
-		hand_props, hand_props_idx, idlookup):
+	def __init__(self, comid, hand_curves, curves_map, 
+		hand_props, props_map, idlookup):
 		"""Provides hand, xs, and usgs rating curve data for the specified comid.
 		'comid' - comid for which data is desired
-		'hand_curves' - NetCDF file containing HAND rating curve data
-		'hand_curves_idx' - csv containing indices of HAND rating curves desired
-		'hand_props' - NetCDF file containing HAND hydraulic property data
-		'hand_props_idx' - csv containing indices of HAND hydraulic properties desired
+		'hand_curves' - NetCDF file (path or open Dataset) containing HAND rating curve data
+		'curves_map' - dict of comid to row index in hand_curves (see comid_index)
+		'hand_props' - NetCDF file (path or open Dataset) containing HAND hydraulic property data
+		'props_map' - dict of comid to row index in hand_props (see comid_index)
 		'xs' - csv containing xs data (must have profile, xsid, and rating curves)
 		'idlookup' - csv lookup table between comid and usgsid"""
 		self.comid = comid
-		print "Retrieving data for comid {0}...".format(self.comid)
+		print("Retrieving data for comid {0}...".format(self.comid))
 
-		self.hand_curves = Dataset(hand_curves, 'r')
-
-		hand_curves_idx = pandas.read_csv(hand_curves_idx)
-		self.hand_curves_idx = hand_curves_idx.loc[ hand_curves_idx['comid'] == \
-			self.comid ]['index'].values[0]
+		self.hand_curves = open_dataset(hand_curves)
+		self.hand_curves_idx = curves_map[self.comid]
 		self.get_hand_curves()
 		
-		self.hand_props = Dataset(hand_props,'r')
-		hand_props_idx = pandas.read_csv(hand_props_idx)
-		self.hand_props_idx = hand_props_idx.loc[ hand_props_idx['comid'] == \
-			self.comid ]['index'].values[0]
+		self.hand_props = open_dataset(hand_props)
+		self.hand_props_idx = props_map[self.comid]
 		self.get_hand_props()
 
 		self.idlookup = idlookup
@@ -54,75 +119,85 @@ class RCData:
 
 	def get_hand_props(self):
 		"""Initializes self.handarea [sqmeters], self.handrad [m], 
-		self.handslope [-], and self.handstage [ft]."""
-		handc = self.hand_props.variables['COMID']
+		self.handslope [-], and self.handstage [ft].
+		Geometry arrays are stored as float32."""
 		handslope = self.hand_props.variables['Slope'] # So
 		handstage = self.hand_props.variables['StageHeight'] # h values for Aw and Hr
 		handarea = self.hand_props.variables['WetArea'] # Aw
 		handrad = self.hand_props.variables['HydraulicRadius'] # Hr
 		handlen = self.hand_props.variables['Length'] # Length
 		handwidth = self.hand_props.variables['Width'] # Width
-		if handc[self.hand_props_idx] == self.comid:
-			self.handarea = handarea[self.hand_props_idx]*(3.28084**2) # Convert sqm to sqft
-			self.handrad = handrad[self.hand_props_idx]*3.28084 # Convert m to ft
-			self.handslope = handslope[self.hand_props_idx] # unitless
-			self.handlen = handlen[self.hand_props_idx]*3.28084 # Convert m to ft
-			self.handwidth = handwidth[self.hand_props_idx]*3.28084 # Convert m to ft
-		handstage = scipy.array(handstage)*3.28084 # Convert m to ft
-		self.handstage = scipy.rint(handstage) # Round to nearest int
+		# Read only this comid's row from each (comid x stage) variable
+		# (fill values become NaN)
+		idx = self.hand_props_idx
+		self.handarea = (read_filled(handarea,(idx,slice(None)))*(3.28084**2)).astype(np.float32) # Convert sqm to sqft
+		self.handrad = (read_filled(handrad,(idx,slice(None)))*3.28084).astype(np.float32) # Convert m to ft
+		self.handslope = read_filled(handslope,idx) # unitless
+		self.handlen = (read_filled(handlen,(idx,slice(None)))*3.28084).astype(np.float32) # Convert m to ft
+		self.handwidth = (read_filled(handwidth,(idx,slice(None)))*3.28084).astype(np.float32) # Convert m to ft
+		# Stage steps are shared by all comids; convert and round in place
+		handstage = read_filled(handstage,slice(None),np.float32)
+		handstage *= np.float32(3.28084) # Convert m to ft
+		np.rint(handstage,out=handstage) # Round to nearest int
+		self.handstage = handstage
 
 	def get_hand_curves(self): 
 		""" Initializes self.handq [cfs] and self.handh [ft]."""
 		handq = self.hand_curves.variables['Q_cfs']
 		handh = self.hand_curves.variables['H_ft']
-		handc = self.hand_curves.variables['COMID']
-		if handc[self.hand_curves_idx] == self.comid:
-			self.handq = handq[self.hand_curves_idx]
-		self.handh = handh
+		self.handq = read_filled(handq,(self.hand_curves_idx,slice(None)),np.float32)
+		self.handh = read_filled(handh,slice(None),np.float32) # Read once rather than keeping the on-disk variable
+
+	def fetch_usgsrc(self,usgsid):
+		""" Returns (usgsh, usgsq) rating curve arrays for a single usgsid """
+		# Parse the exsa rating table with pandas; after the '#'
+		# comments come a header row (INDEP, SHIFT, DEP, STOR) and a row of
+		# column formats (e.g. '16N'), which is dropped before casting
+		raw = _fetch_url(self.usgsrc.format(str(usgsid)))
+		try:
+			rc = pandas.read_csv(io.BytesIO(raw),sep='\t',
+				comment='#',usecols=['INDEP','SHIFT','DEP']).iloc[1:].astype(np.float64)
+		except ValueError: # no rating table (EmptyDataError) or missing columns
+			rc = pandas.DataFrame(columns=['INDEP','SHIFT','DEP'],dtype=np.float64)
+		rc = rc[rc['DEP'] >= 1] # Remove where Q < 1
+		# An empty table raises IndexError below, reported as an RC error
+		usgsq = rc['DEP'].values
+		# apply shift to stage height where SHIFT is shift magnitude
+		usgsh = rc['INDEP'].values - rc['SHIFT'].values
+		shift = usgsh[0]
+		return usgsh - shift, usgsq # Normalize usgsh over bottom depth
 
 	def get_usgsrc(self):
-		""" Initializes self.usgsq and self.usgsh """
+		""" Initializes self.usgsq and self.usgsh as lists with one array per 
+		usgsid (rating tables differ in length, so they are not stacked) """
 		self.usgsh = []
 		self.usgsq = []
-		for usgsid in self.usgsids:
-			urlfile = urllib.urlopen(self.usgsrc.format(str(usgsid)))
-			urllines = urlfile.readlines()
-			findData = False
-			usgsq = scipy.array([])
-			usgsh = scipy.array([])
-			for j in range(len(urllines)):
-				line = urllines[j]
-				if not findData and not re.search('[a-zA-Z]',line): # No letters
-					findData = True
-				if findData and float(line.split('\t')[2]) >= 1: # Remove where Q < 1
-					current = line.split('\t')
-					usgsq = scipy.append( usgsq, float(current[2]) )
-					# apply shift to stage height where current[1] is shift magnitude
-					usgsh = scipy.append( usgsh, float(current[0]) - float(current[1]) )
-			shift = usgsh[0]
-			self.usgsh.append((usgsh - shift)) # Normalize usgsh over bottom depth
-			self.usgsq.append(usgsq)
-		self.usgsh = scipy.array(self.usgsh)
-		self.usgsq = scipy.array(self.usgsq)
+		# Requests are network-bound, so fetch all gages concurrently
+		with ThreadPoolExecutor(max_workers=max(1,min(8,len(self.usgsids)))) as ex:
+			for usgsh, usgsq in ex.map(self.fetch_usgsrc,self.usgsids):
+				self.usgsh.append(usgsh)
+				self.usgsq.append(usgsq)
 
 class RCDist(RCData):
 
-	def interp(self,x,y,kind='power'):
-		"""Interpolate over data with (x,y) pairs
+	def powerlaw(self,x,y):
+		"""Fit y = a * x**b to (x,y) pairs in log space, returning (a, b)"""
+		logx = np.log(x)[1:] # ln(0) is neg inf, so remove first term
+		logy = np.log(y)[1:] # ln(0) is neg inf, so remove first term
+		b, loga = np.polyfit(logx,logy,1) # slope, intercept from (y = a + b*x)
+		return np.exp(loga), b
+
+	def fit_at_data(self,x,y,kind='power'):
+		"""Evaluate the kind of fit to (x,y) pairs at x itself, without 
+		building an interpolant; linear and cubic interpolants pass 
+		through their data points, so these simply return y
 		'x' - x data,
 		'y' - y data,
 		'kind' - powerlaw ('power'), linear ('linear), or cubic ('cubic')"""
-		if kind == 'power': # powerlaw interpolation
-			logx = scipy.log(x)[1:] # ln(0) is neg inf, so remove first term
-			logy = scipy.log(y)[1:] # ln(0) is neg inf, so remove first term
-			b, loga = scipy.polyfit(logx,logy,1) # slope, intercept from (y = a + b*x)
-			a = scipy.exp(loga)
-			f = lambda x: a * x**b # powerlaw function
-
-		if kind == 'linear' or kind == 'cubic': # linear interpolation
-			f = scipy.interpolate.interp1d(x,y,kind=kind)
-
-		return f
+		if kind == 'power':
+			a, b = self.powerlaw(x,y)
+			return a * np.power(x,b)
+		return y
 
 	def mannings_n(self,area,hydrad,slope,disch):
 		""" Calculates manning's roughness from discharge. 
@@ -130,45 +205,79 @@ class RCDist(RCData):
 		'hydrad' - self.handrad (hydraulic radius),
 		'slope' - self.handslope (bed slope), and
 		'disch' - any discharge values"""
-		res = 1.49*area*scipy.power(hydrad,(2/3.0))*scipy.sqrt(slope)/disch.T
-		return res.T
+		# Broadcast like the original expression (raises ValueError on mismatched
+		# shapes) and flatten, since the kernel walks 1-D arrays without bounds checks
+		area, hydrad, disch = np.broadcast_arrays(np.asarray(area),np.asarray(hydrad),
+			np.asarray(disch,dtype=np.float64).T)
+		res = _mannings(area.ravel(),hydrad.ravel(),float(slope),disch.ravel())
+		return res.reshape(disch.shape).T
 
 	def optimize_n(self):
 		"""Determine manning's roughness required to fit
 		HAND curve to USGS curve at each 1-ft depth interval"""
-		usgs_hlist = []
-		usgs_hset = set()
-		usgs_qlist = []
-		for h in self.handstage: 
-			res = min(enumerate(self.usgsh[0]), key=lambda x:abs(x[1]-h))
-			if res[1] not in usgs_hset:
-				usgs_hlist.append(res[1])
-				usgs_hset.add(res[1])
-				usgs_qlist.append(self.usgsq[0][res[0]])
-		usgs_hlist = scipy.array(usgs_hlist[:-1])
-		usgs_qlist = scipy.array(usgs_qlist[:-1])
+		# Shifts can make USGS stages non-monotonic, so sort them (stably,
+		# keeping equal stages in table order) before bracketing
+		order = np.argsort(self.usgsh[0],kind='stable')
+		uh = np.asarray(self.usgsh[0])[order]
+		uq = np.asarray(self.usgsq[0])[order]
+		hs = np.asarray(self.handstage)
+		if len(uh) == 1: # single-point table; every stage maps to it
+			nearest = np.zeros(len(hs),dtype=np.intp)
+		else:
+			# Bracket each HAND stage within the ascending USGS stages
+			idx = np.clip(np.searchsorted(uh,hs),1,len(uh)-1)
+			left = idx - 1
+			# Take the closer neighbor; ties go to the lower stage
+			nearest = np.where(np.abs(uh[left]-hs) <= np.abs(uh[idx]-hs),left,idx)
+			# Use the first table entry of any repeated stage value
+			nearest = np.searchsorted(uh,uh[nearest],side='left')
+		# Drop repeated stage values, keeping order of first occurrence
+		_, first = np.unique(uh[nearest],return_index=True)
+		nearest = nearest[np.sort(first)]
+		usgs_hlist = uh[nearest][:-1]
+		usgs_qlist = uq[nearest][:-1]
 		area = self.handarea[:len(usgs_qlist)]
 		hydrad = self.handrad[:len(usgs_qlist)]
 		opt_n = self.mannings_n(area=area,hydrad=hydrad,slope=self.handslope,disch=usgs_qlist)
-		return zip(usgs_hlist,usgs_qlist,opt_n)
+		return list(zip(usgs_hlist,usgs_qlist,opt_n))
 
 	def get_usgs_geometry(self,usgsid):
-		""" Retrieves USGS geometry data """
+		""" Retrieves USGS geometry data as a DataFrame of chan_width, 
+		gage_height_va, and current_rating_nu (missing entries are NaN) """
 
 		weburl = 'https://waterdata.usgs.gov/tx/nwis/measurements?site_no={0}&agency_cd=USGS&format=rdb_expanded'
 
 		# Retrieve data
-		urlfile = urllib.urlopen(weburl.format(str(usgsid)))
-		urllines = urlfile.readlines()
-		urllines = [line.split('\t') for line in urllines if line[0] != '#'] # Ignore details at beginning
-		del urllines[1] # Remove additional unnecessary details
-
-		# Separate headers and data
-		keys = urllines[0]
-		values = urllines[1:]
-
-		d = {k:list(v) for k,v in zip(keys,zip(*values))}
-		return d
+		raw = _fetch_url(weburl.format(str(usgsid)))
+
+		# Count details at beginning; '#' may also appear inside remarks,
+		# so only leading lines are skipped rather than using comment='#'
+		ncomment = 0
+		for line in io.BytesIO(raw):
+			if not line.startswith(b'#'):
+				break
+			ncomment += 1
+
+		# Skip the details and the additional unnecessary row below the headers
+		return pandas.read_csv(io.BytesIO(raw),sep='\t',
+			skiprows=lambda i: i < ncomment or i == ncomment+1,
+			usecols=['chan_width','gage_height_va','current_rating_nu'],
+			dtype=np.float64)
+
+	def mirror_xsect(self,w,h):
+		"""Returns separate x and y float32 arrays of a symmetric cross-section 
+		organized as LHS (descending height), origin, RHS (ascending height)
+		'w' - one-sided widths, ordered by ascending height
+		'h' - heights matching w"""
+		n = len(w)
+		xs_x = np.empty(2*n+1,dtype=np.float32)
+		xs_y = np.empty(2*n+1,dtype=np.float32)
+		np.negative(w[::-1],out=xs_x[:n]) # change widths to negative for LHS
+		xs_y[:n] = h[::-1]
+		xs_x[n] = xs_y[n] = 0 # origin
+		xs_x[n+1:] = w
+		xs_y[n+1:] = h
+		return xs_x, xs_y
 
 	def draw_xsect(self,save=False):
 
@@ -176,68 +285,47 @@ class RCDist(RCData):
 		fig, ax = plt.subplots()
 
 		# Create and draw HAND cross-section polygon
-		# Generate origin for plotting (note: must be done prior to for loop)
-		hand_xsect = scipy.array([[0,0]])
+		n = len(self.handstage)
+		delta_w = self.handwidth[:n]/np.float32(2.0) # one-sided top-width at each height step
+		xs_x, xs_y = self.mirror_xsect(delta_w,np.arange(n))
 
-		for h in range(len(self.handstage)):
-			# Retrieve top-width data for this height step
-			delta_w = self.handwidth[h]/2.0
-
-			# Collect negative and positive widths for this height step
-			neg = scipy.array([[-delta_w,h]])
-			pos = scipy.array([[delta_w,h]])
-
-			# Organize final data as LHS, origin, RHS
-			hand_xsect = scipy.concatenate([neg,hand_xsect,pos])
-
-		# Draw HAND cross-section
-		hand_poly = plt.Polygon(hand_xsect,closed=None,fill=None,edgecolor='b',
+		# Draw HAND cross-section (Polygon takes (x,y) rows)
+		hand_poly = plt.Polygon(np.column_stack((xs_x,xs_y)),closed=None,fill=None,edgecolor='b',
 			linewidth=5,label='HAND X-Sect')
 		ax.add_artist(hand_poly)
 
 		usgs_max_height = 0
 		usgs_max_width = 0
 
-		# Create and draw USGS cross-section polygon
-		for usgsid in self.usgsids:
-			# Generate origin for plotting (note: must be done within for loop)
-			usgs_xsect = scipy.array([[0,0]])
-
-			# Retrieve dictionary with USGS data
-			d = self.get_usgs_geometry(usgsid)
-			
-			# Collect indices of most recent rating number only
-			ratings = [(ind,float(r)) for ind,r in enumerate(d['current_rating_nu']) if filter(None,r)]
+		# Retrieve USGS geometry data for all gages concurrently
+		with ThreadPoolExecutor(max_workers=max(1,min(8,len(self.usgsids)))) as ex:
+			geometries = list(ex.map(self.get_usgs_geometry,self.usgsids))
 
-			print usgsid
+		# Create and draw USGS cross-section polygon
+		for usgsid, df in zip(self.usgsids,geometries):
+			print(usgsid)
 
-			# Find index of latest occurence of most recent rating number
-			rnos = zip(*ratings)[1]
-			most_recent = ratings[rnos.index(rnos[-1])][0]
+			# Most recent rating number is the last one reported
+			r = df['current_rating_nu'].values
+			last_r = r[~np.isnan(r)][-1]
 
 			# Collect height and width data (note: divide width by 2 for one-sided width), 
 			# while removing pairs missing one element and taking only most recent rating number
-			ratings = [float(r) for r in d['current_rating_nu'] if filter(None,r)]
-
-			data = [(float(w)/2.0,float(h))\
-				for w,h,r in zip(d['chan_width'],d['gage_height_va'],d['current_rating_nu'])\
-				if filter(None,w) and filter(None,h) and filter(None,r) and float(r) == ratings[-1]]
-			print data
-
-			# data = [filter(None,t) for t in zip(d['gage_height_va'],d['chan_width'])]
+			# (NaN ratings never equal last_r, so one mask covers all three columns)
+			valid = df['chan_width'].notna().values & df['gage_height_va'].notna().values & (r == last_r)
+			w = df['chan_width'].values[valid]/2.0
+			h = df['gage_height_va'].values[valid]
 
 			# Sort data: ascending height and ascending width
-			pos = scipy.array(sorted(data,key=operator.itemgetter(1,0))) 
-
-			# Sort data: ascending height and descending width
-			neg = scipy.array(sorted(data,key=operator.itemgetter(1,0),reverse=True)) 
-			neg[:,0] = -neg[:,0] # change widths to negative for plotting
+			order = np.lexsort((w,h))
+			w = w[order]
+			h = h[order]
+			print(np.column_stack((w,h)))
 
-			# Organize final data as LHS, origin, RHS
-			usgs_xsect = scipy.concatenate([neg,usgs_xsect,pos])
+			xs_x, xs_y = self.mirror_xsect(w,h)
 
-			# Draw USGS cross-section
-			usgs_poly = plt.Polygon(usgs_xsect,closed=None,fill=None,edgecolor='g',
+			# Draw USGS cross-section (Polygon takes (x,y) rows)
+			usgs_poly = plt.Polygon(np.column_stack((xs_x,xs_y)),closed=None,fill=None,edgecolor='g',
 				linewidth=5,label='USGS X-Sect')
 			ax.add_artist(usgs_poly)
 
@@ -288,17 +376,17 @@ class RCDist(RCData):
 			# Plot curves
 			for q,h in zip(self.usgsq,self.usgsh):
 				if kind == 'cubic': 
-					print 'USGS interpolation plotted as power-law fit'
-					f = self.interp(x=q,y=h,kind='power')
+					print('USGS interpolation plotted as power-law fit')
+					h_fit = self.fit_at_data(x=q,y=h,kind='power')
 				else: 
-					f = self.interp(x=q,y=h,kind=kind)
-				ax.plot(q,f(q),
+					h_fit = self.fit_at_data(x=q,y=h,kind=kind)
+				ax.plot(q,h_fit,
 					label='usgs',c='g', linewidth=5)
 
 		if hand: # Plot interpolated HAND rating curve
 			# Plot curves
-			f = self.interp(x=self.handq,y=self.handh,kind=kind)
-			ax.plot(self.handq,f(self.handq),
+			h_fit = self.fit_at_data(x=self.handq,y=self.handh,kind=kind)
+			ax.plot(self.handq,h_fit,
 				label='hand',c='b', linewidth=5)
 
 		# Plot graph
@@ -331,9 +419,15 @@ if __name__ == '__main__':
 	
 	# Path to HAND files
 	hand_curves = 'oniondata/handratingcurves.nc'
-	hand_curves_idx = 'oniondata/handrc_idx.csv'
 	hand_props = 'oniondata/OnionCreek.nc'
-	hand_props_idx = 'oniondata/handnc_idx.csv'
+
+	# Open HAND NetCDF files once and share them across all comids
+	hc = open_dataset(hand_curves)
+	hp = open_dataset(hand_props)
+
+	# Build comid --> index lookups once from each file's COMID variable
+	curves_map = comid_index(hc)
+	props_map = comid_index(hp)
 
 	# Pre-process XS data
 	xsintersect = pandas.read_csv('oniondata/xsdata/xsintersect.csv',
@@ -362,14 +456,13 @@ if __name__ == '__main__':
 	# Instantiate RCDist class for each comid in watershed
 	for comid in comids:
 		try: 
-			rcdist = RCDist(comid,hand_curves, hand_curves_idx, 
-				hand_props,hand_props_idx,idlookup)
-			print 'COMID {0} Collected Successfully!\n'.format(str(comid))
-			# print 'usgsid:',[usgsid for usgsid in rcdist.usgsids]
+			rcdist = RCDist(comid,hc,curves_map,hp,props_map,idlookup)
+			print('COMID {0} Collected Successfully!\n'.format(str(comid)))
+			# print('usgsid:',[usgsid for usgsid in rcdist.usgsids])
 			# rcdist.draw_xsect(save='results/xsects/{0}'.format(str(comid)))
 			rcdist.draw_xsect(save='results/xsects/hand_vs_usgs_xsect_recent_ratings_only_trimmed_{0}'.format(str(comid)))
 
-			# print rcdist.optimize_n()
+			# print(rcdist.optimize_n())
 
 			# Plot rating curves from data
 			# rcdist.plot_rc(save=False,hand=True,usgs=True,
@@ -377,8 +470,12 @@ if __name__ == '__main__':
 
 			continue
 		except TypeError: 
-			print 'COMID {0} XS Error\n'.format(str(comid))
+			print('COMID {0} XS Error\n'.format(str(comid)))
 			continue
-		except IndexError: 
-			print 'COMID {0} RC Error\n'.format(str(comid))
-			continue
\ No newline at end of file
+		except (IndexError, KeyError, URLError): # KeyError if comid missing from HAND index,
+			# URLError if a USGS page fails to download (HTTP error or no connection)
+			print('COMID {0} RC Error\n'.format(str(comid)))
+			continue
+
+	hc.close()
+	hp.close()